@@ -21,35 +21,104 @@ __author__ = "Luís Gomes"
 __version__ = "0.2.0"
 
 
-import json
+from collections import OrderedDict
+
 import uasyncio
 
+try:
+    from time import ticks_add, ticks_diff, ticks_ms  # MicroPython
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(ticks1, ticks2):
+        return ticks1 - ticks2
+
+try:
+    import ujson as _json  # MicroPython
+except ImportError:
+    import json as _json
+
+# orjson.loads is not used because it turns integers wider than 64 bits into
+# floats, which would change request ids and params
+_loads = _json.loads
+
+try:
+    import orjson as _orjson  # CPython; dumps() already returns bytes
+except ImportError:
+
+    def _dumps(obj):
+        "serializes obj to JSON and returns it as bytes"
+        return _json.dumps(obj).encode("utf-8")
+
+else:
+
+    def _dumps(obj):
+        "serializes obj to JSON and returns it as bytes"
+        try:
+            return _orjson.dumps(obj, option=_orjson.OPT_NON_STR_KEYS)
+        except TypeError:  # e.g. integers wider than 64 bits
+            return _json.dumps(obj).encode("utf-8")
+
+
+# On MicroPython, loads() was observed to be several times faster after
+# dumps() has been called once, so we call it here at import time.
+_json.dumps(None)
+
 
 JSONRPC_VERSION = "2.0"
 
+# constant parts of a successful response, which is built by concatenation
+_RESULT_PREFIX = b'{"jsonrpc":"' + JSONRPC_VERSION.encode() + b'","id":'
+_RESULT_INFIX = b',"result":'
+_RESULT_SUFFIX = b"}"
+
+# constant beginning of an error response
+_ERROR_PREFIX = b'{"jsonrpc":"' + JSONRPC_VERSION.encode() + b'","error":{"code":'
+
+READ_SIZE = 4096  # max number of bytes read from a client socket at once
+
 
 class RequestError(Exception):
     "Umbrella class for all exceptions raised by UAJSONRPCServer.handle_request()"
 
+    _cached_response = None  # set per subclass on first use
+
     def __init__(self, request_id=None, data=None):
         self.request_id = request_id
         self.data = data
 
     def get_response(self):
-        "returns a JSON-RPC formatted response containing error data"
-        error = {
-            "code": self.code,
-            "message": self.message,
-        }
+        "returns a JSON-RPC formatted response (bytes) containing error data"
+        if self.data is None and self.request_id is None:
+            # response is constant for each error class; serialize it only once
+            response = self._cached_response
+            if response is None:
+                response = type(self)._cached_response = self._build_response()
+            return response
+        return self._build_response()
+
+    def _build_response(self):
+        # code and message are class constants which need no JSON escaping
+        parts = [
+            _ERROR_PREFIX,
+            str(self.code).encode(),
+            b',"message":"',
+            self.message.encode(),
+            b'"',
+        ]
         if self.data is not None:
-            error["data"] = self.data
-        response = {
-            "jsonrpc": JSONRPC_VERSION,
-            "error": error,
-        }
+            parts += (b',"data":', _dumps(self.data))
+        parts.append(b"}")
         if self.request_id is not None:
-            response["id"] = self.request_id
-        return json.dumps(response)
+            parts += (b',"id":', _dumps(self.request_id))
+        parts.append(b"}")
+        return b"".join(parts)
 
 
 class RequestParseError(RequestError):
@@ -59,7 +128,7 @@ class RequestParseError(RequestError):
 
 
 class InvalidRequest(RequestError):
-    "Error raised when request is valid JSON but not a valid JSON object"
+    "Error raised when request is not a valid JSON-RPC request object"
     code = -32600
     message = "Invalid request"
 
@@ -82,6 +151,57 @@ class ServerError(RequestError):
     message = "Server error"
 
 
+def _unpack_request(request_dict, _version=JSONRPC_VERSION):
+    """
+    validates a request object
+
+    returns a tuple (request_id, method_name, params)
+    """
+    if not isinstance(request_dict, dict):
+        raise InvalidRequest()
+    get = request_dict.get
+    if get("jsonrpc") != _version:
+        raise InvalidRequest()
+    method_name = get("method")
+    if not isinstance(method_name, str):
+        raise InvalidRequest(data="Method must be a string")
+    params = get("params")
+    if params is not None and not isinstance(params, (list, dict)):
+        raise InvalidRequest(data="Params must be an array or object")
+    return get("id"), method_name, params
+
+
+def _parse_request(request_str, _loads=_loads, _unpack=_unpack_request):
+    """
+    parses and validates a request envelope in a single step
+
+    returns a tuple (request_id, method_name, params) for a single request,
+    or a non-empty list of (not yet validated) request objects for a batch
+
+    (globals used on every call are bound as default arguments because local
+    name lookups are much faster than global ones on MicroPython)
+    """
+    try:
+        request = _loads(request_str)
+    except ValueError as e:
+        raise RequestParseError() from e
+    if isinstance(request, list) and request:
+        return request
+    return _unpack(request)
+
+
+def _cache_key(method_name, params):
+    """
+    returns a key identifying a call
+
+    params are serialized so that values which are equal in Python but not in
+    JSON (e.g. 1, 1.0 and true) get different keys
+    """
+    if isinstance(params, dict):
+        return method_name, True, _dumps(sorted(params.items()))
+    return method_name, False, _dumps(params)
+
+
 class UAJSONRPCServer:
     """
     Asynchronous JSON-RPC server implementation (based on uasyncio)
@@ -92,15 +212,79 @@ class UAJSONRPCServer:
     <-- {"jsonrpc": "2.0", "result": 19, "id": 3}
     """
 
-    def __init__(self, host="0.0.0.0", port=10000):
+    def __init__(
+        self,
+        host="0.0.0.0",
+        port=10000,
+        debug=False,
+        cache_size=64,
+        max_request_size=4096,
+        max_pending_requests=8,
+    ):
         self.host = host
         self.port = port
+        self.debug = debug  # print every request and response
+        self.max_request_size = max_request_size  # in bytes, excluding newline
+        self.max_pending_requests = max_pending_requests  # per connection
         self.methods = dict()
         self.server = None
-
-    def register(self, name, method, param_names, is_coroutine=False):
-        "register a method to become available to JSON-RPC clients"
-        self.methods[name] = (method, param_names, is_coroutine)
+        self.cache = OrderedDict()  # serialized results of cacheable methods
+        self.cache_size = cache_size  # max number of cached results; 0 disables
+
+    def register(
+        self,
+        name,
+        method,
+        param_names,
+        is_coroutine=False,
+        cacheable=False,
+        ttl=None,
+    ):
+        """
+        register a method to become available to JSON-RPC clients
+
+        is_coroutine must be True if method is a coroutine function (async def);
+        it is not detected at call time
+
+        if cacheable is True, results are cached by params, and repeated calls
+        are answered from the cache (for at most ttl seconds, if ttl is given)
+        without calling the method; use only for methods without side effects
+        """
+        param_names_error = f"Method {name} param names are: {', '.join(param_names)}"
+        ttl_ms = None if ttl is None else int(ttl * 1000)
+        # drop results cached for a method previously registered with this name
+        for key in [key for key in self.cache if key[0] == name]:
+            del self.cache[key]
+        self.methods[name] = (
+            method,
+            param_names,
+            frozenset(param_names),
+            param_names_error,
+            is_coroutine,
+            cacheable,
+            ttl_ms,
+        )
+
+    def _cache_get(self, key):
+        "returns the cached serialized result for key, or None if not cached"
+        try:
+            entry = self.cache.pop(key)
+        except KeyError:
+            return None
+        result_bytes, expires = entry
+        if expires is not None and ticks_diff(expires, ticks_ms()) <= 0:
+            return None  # expired (and already removed)
+        self.cache[key] = entry  # mark it as the most recently used
+        return result_bytes
+
+    def _cache_put(self, key, result_bytes, ttl_ms):
+        "stores a serialized result in the cache, evicting the least recently used"
+        if key in self.cache:
+            del self.cache[key]  # concurrent miss already stored it; replace it
+        elif len(self.cache) >= self.cache_size:
+            del self.cache[next(iter(self.cache))]
+        expires = None if ttl_ms is None else ticks_add(ticks_ms(), ttl_ms)
+        self.cache[key] = (result_bytes, expires)
 
     async def start(self):
         "starts the server as an asynchronous task (coroutine)"
@@ -123,86 +307,184 @@ class UAJSONRPCServer:
         print("Server stoped")
 
     async def handle_connection(self, reader, writer):
-        "handles a client connect calling self.handle_request() for each request"
+        "handles a client connection, handling each request in a separate task"
         peername = writer.get_extra_info("peername")
         print(f"Accepted client connection from {peername}")
+        write_lock = uasyncio.Lock()  # prevents responses from interleaving
+        tasks = []  # requests being handled concurrently
+        task_done = uasyncio.Event()  # set whenever one of the tasks finishes
         try:
+            buffer = b""
             fatal_error = False
             while not fatal_error:
-                request_str = (await reader.readline()).decode()
-                if not request_str:
+                chunk = await reader.read(READ_SIZE)
+                if chunk:
+                    buffer += chunk
+                elif buffer:
+                    buffer += b"\n"  # last request was not terminated by a newline
+                else:
                     break
-                request_str = request_str.strip()
-                response_str = None
-                print(f"<-- {request_str}")
-                try:
-                    response_str = await self.handle_request(request_str)
-                except RequestError as exception:
-                    response_str = exception.get_response()
-                    if isinstance(exception, (RequestParseError, InvalidRequest)):
+                start = 0
+                while True:
+                    end = buffer.find(b"\n", start)
+                    if end < 0 and len(buffer) - start <= self.max_request_size:
+                        break  # wait for the rest of the request
+                    try:
+                        # reject oversized requests before buffering or parsing
+                        # them, so that clients cannot exhaust our memory
+                        if end < 0 or end - start > self.max_request_size:
+                            raise RequestParseError(
+                                data=f"Request exceeds {self.max_request_size} bytes"
+                            )
+                        request_str = buffer[start:end].decode().strip()
+                        start = end + 1
+                        if self.debug:
+                            print(f"<-- {request_str}")
+                        request = _parse_request(request_str)
+                    except RequestError as exception:
+                        response = exception.get_response()
+                        await self._write_response(writer, write_lock, response)
                         fatal_error = True  # stop handling requests on this socket
-                if response_str:
-                    writer.write((response_str + "\n").encode("utf-8"))
-                    await writer.drain()
-                    print(f"--> {response_str}")
+                        break
+                    tasks = [task for task in tasks if not task.done()]
+                    while len(tasks) >= self.max_pending_requests:
+                        # stop reading requests until any of them is handled
+                        task_done.clear()
+                        await task_done.wait()
+                        tasks = [task for task in tasks if not task.done()]
+                    # a slow method must not delay the following requests
+                    task = uasyncio.create_task(
+                        self._dispatch(request, writer, write_lock, task_done)
+                    )
+                    tasks.append(task)
+                buffer = buffer[start:]
         except Exception as e:
             print(f"Exception: {e!r}")
         finally:
+            await uasyncio.gather(*tasks, return_exceptions=True)
             reader.close()
             writer.close()
             print("Connection closed")
 
+    async def _dispatch(self, request, writer, write_lock, task_done):
+        "handles a parsed request and writes its response, if any"
+        try:
+            try:
+                response = await self._handle(request)
+            except RequestError as exception:
+                response = exception.get_response()
+            if response:
+                await self._write_response(writer, write_lock, response)
+        except Exception as e:
+            print(f"Exception: {e!r}")
+        finally:
+            task_done.set()
+
+    async def _write_response(self, writer, write_lock, response):
+        "writes a response to the client, one response at a time"
+        async with write_lock:
+            # a single write, so that the newline is not sent in a separate
+            # segment (which Nagle's algorithm may delay until an ACK)
+            writer.write(response + b"\n")
+            await writer.drain()
+        if self.debug:
+            print(f"--> {response.decode()}")
+
     async def handle_request(self, request_str):
-        "handle a single request"
+        "handle a single request; returns the JSON-RPC response as bytes (or None)"
         # see https://www.jsonrpc.org/specification#request_object
-        try:
-            request_dict = json.loads(request_str)
-        except ValueError as e:
-            raise RequestParseError() from e
-        if not isinstance(request_dict, dict):
-            raise InvalidRequest()
-        jsonrpc_version = request_dict.get("jsonrpc", None)
-        if jsonrpc_version != JSONRPC_VERSION:
-            raise InvalidRequest()
-        request_id = request_dict.get("id", None)
-        method_name = request_dict.get("method", None)
-        if method_name not in self.methods:
+        return await self._handle(_parse_request(request_str))
+
+    async def _handle(self, request):
+        "handles a request or batch as returned by _parse_request()"
+        if isinstance(request, list):
+            return await self._handle_batch(request)
+        return await self._call_method(*request)
+
+    async def _handle_batch(self, requests):
+        "handles a batch of requests; returns a single JSON array response (or None)"
+        # see https://www.jsonrpc.org/specification#batch
+        responses = []
+        for request_dict in requests:
+            try:
+                response = await self._call_method(*_unpack_request(request_dict))
+            except RequestError as exception:
+                response = exception.get_response()
+            if response:
+                responses.append(response)
+        if not responses:
+            return None  # batch contained only notifications
+        # responses are already serialized, so the array is built by joining them
+        return b"[" + b",".join(responses) + b"]"
+
+    async def _call_method(
+        self,
+        request_id,
+        method_name,
+        params,
+        _dumps=_dumps,
+        _prefix=_RESULT_PREFIX,
+        _infix=_RESULT_INFIX,
+        _suffix=_RESULT_SUFFIX,
+    ):
+        """
+        calls the requested method; returns the JSON-RPC response as bytes (or None)
+
+        (globals used on the success path are bound as default arguments, see
+        _parse_request)
+        """
+        entry = self.methods.get(method_name)
+        if entry is None:
             raise MethodNotFound(request_id)
-        params = request_dict.get("params", None)
-        method, param_names, is_coroutine = self.methods[method_name]
+        (
+            method,
+            param_names,
+            frozen_names,
+            param_names_error,
+            is_coroutine,
+            cacheable,
+            ttl_ms,
+        ) = entry
         num_params = len(param_names)
-        if (
-            params is None
-            and num_params
-            or isinstance(params, (list, dict))
-            and len(params) != num_params
-        ):
+        # params is None, a list or a dict (checked by _parse_request)
+        if (0 if params is None else len(params)) != num_params:
             raise InvalidParams(data=f"Method {method_name} takes {num_params} params")
-        if isinstance(params, list):
-            positional_params = params
-            named_params = {}
-        elif isinstance(params, dict):
-            if set(param_names) != set(params.keys()):
-                param_names_str = ", ".join(param_names)
-                raise InvalidParams(
-                    data=f"Method {method_name} param names are: {param_names_str}"
-                )
-            positional_params = []
-            named_params = params
+        named = isinstance(params, dict)
+        if named:
+            # len(params) == num_params was checked above, so it suffices to
+            # check that every given name is valid
+            for param_name in params:
+                if param_name not in frozen_names:
+                    raise InvalidParams(data=param_names_error)
+        if cacheable and self.cache_size > 0:
+            key = _cache_key(method_name, params)
         else:
-            raise InvalidRequest(data="Params must be an array or object")
-        try:
-            if is_coroutine:
-                result = await method(*positional_params, **named_params)
-            else:
-                result = method(*positional_params, **named_params)
-        except Exception as e:
-            raise ServerError(request_id, repr(e)) from e
+            key = None
+        result_bytes = None if key is None else self._cache_get(key)
+        if result_bytes is None:
+            try:
+                if not num_params:
+                    result = method()
+                elif named:
+                    result = method(**params)
+                else:
+                    result = method(*params)
+                if is_coroutine:
+                    result = await result
+            except Exception as e:
+                raise ServerError(request_id, repr(e)) from e
+            if request_id is None and key is None:
+                return None  # request was notification; no response needed
+            try:
+                result_bytes = _dumps(result)
+            except Exception as e:  # result is not JSON serializable
+                raise ServerError(request_id, repr(e)) from e
+            if key is not None:
+                self._cache_put(key, result_bytes, ttl_ms)
         if request_id is None:
             return None  # request was notification; no response needed
-        response_obj = {
-            "jsonrpc": JSONRPC_VERSION,
-            "id": request_id,
-            "result": result,
-        }
-        return json.dumps(response_obj)
+        if type(request_id) is int:  # most common case; bool is excluded
+            id_bytes = str(request_id).encode()
+        else:
+            id_bytes = _dumps(request_id)
+        return b"".join((_prefix, id_bytes, _infix, result_bytes, _suffix))